@@ -21,6 +21,7 @@ setup(
         ],
     },
     install_requires=[
+        "cryptography>=3.1",
         "libconf~=2.0.1",
         "setuptools~=57.0.0",
     ],
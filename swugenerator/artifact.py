@@ -1,9 +1,213 @@
 # Copyright (C) 2022 Stefano Babic
 #
 # SPDX-License-Identifier: GPLv3
+import functools
+import gzip
 import hashlib
+import logging
 import os
+import shutil
+import ssl
 import subprocess
+import sys
+import zlib
+
+from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.padding import PKCS7
+
+try:
+    from isal import igzip_threaded, isal_zlib
+except ImportError:
+    igzip_threaded = None
+    isal_zlib = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Errors raised by the in-process compressors
+COMPRESSION_ERRORS = (zlib.error,)
+if isal_zlib:
+    COMPRESSION_ERRORS += (isal_zlib.error,)
+if zstandard:
+    COMPRESSION_ERRORS += (zstandard.ZstdError,)
+
+# Chunk size when streaming artifacts
+BUFFER_SIZE = 1024 * 1024
+# AES-256-CBC, as SWUpdate expects
+AES_KEY_SIZE = 32
+AES_IV_SIZE = 16
+# Compression level for zlib artifacts
+ZLIB_LEVEL = 6
+# isal only has levels 0 to 3, 3 is the one closest to ZLIB_LEVEL
+ISAL_LEVEL = 3
+
+
+def _cpu_has_sha_extensions():
+    # x86 reports SHA-NI as "sha_ni", arm64 reports "sha2"
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags = line.split(":", 1)[-1].split()
+                    return "sha_ni" in flags or "sha2" in flags
+    except OSError:
+        pass
+    return None
+
+
+def log_hash_backend():
+    openssl_backend = getattr(hashlib.sha256, "__name__", "") == "openssl_sha256"
+    logging.info(
+        "SHA256 computed by %s",
+        ssl.OPENSSL_VERSION if openssl_backend else "Python builtin implementation",
+    )
+    # Either one missing means no hardware accelerated SHA256
+    if not openssl_backend:
+        logging.warning(
+            "SHA256 is not computed by OpenSSL, hashing big artifacts is slower"
+        )
+    elif _cpu_has_sha_extensions() is False:
+        logging.info("CPU has no SHA extensions, hashing big artifacts is slower")
+
+
+@functools.lru_cache(maxsize=512)
+def _sha256_of(path, mtime_ns, size):
+    # mtime and size are part of the key, so a file rewritten
+    # in the meantime is hashed again
+    with open(path, "rb") as f:
+        if sys.version_info >= (3, 11):
+            m = hashlib.file_digest(f, "sha256")
+        else:
+            m = hashlib.sha256()
+            buf = memoryview(bytearray(BUFFER_SIZE))
+            while True:
+                n = f.readinto(buf)
+                if not n:
+                    break
+                m.update(buf[:n])
+    return m.hexdigest()
+
+
+def index_artifacts(artifactdirs):
+    # Map each filename to its path in the first directory holding it,
+    # with one scandir per artifact directory instead of a stat per lookup
+    index = {}
+    for libdir in artifactdirs:
+        try:
+            with os.scandir(libdir) as it:
+                for e in it:
+                    if e.is_file() or e.is_dir():
+                        index.setdefault(e.name, e.path)
+        except OSError:
+            pass
+    return index
+
+
+def find_artifact(filename, artifactdirs, index=None):
+    # Plain filenames are looked up in the index built by index_artifacts(),
+    # if any. Names with a directory part are searched on the filesystem.
+    in_subdir = os.sep in filename or (os.altsep and os.altsep in filename)
+    if index is not None and not in_subdir:
+        return index.get(filename)
+    for libdir in artifactdirs:
+        fname = os.path.join(libdir, filename)
+        if os.path.exists(fname):
+            return fname
+    return None
+
+
+def _pipe(cmd, fin, fout):
+    # The tool reads fin and its output is streamed to fout
+    with subprocess.Popen(cmd, stdin=fin, stdout=subprocess.PIPE) as proc:
+        shutil.copyfileobj(proc.stdout, fout, BUFFER_SIZE)
+    if proc.returncode:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+
+
+def _compress(fin, fout, cmp, threads=1):
+    if cmp == "zlib" and shutil.which("pigz"):
+        # pigz is multithreaded and, as gzip did before, rsyncable
+        cmd = ["pigz", "-p", str(threads), f"-{ZLIB_LEVEL}", "-n", "--rsyncable", "-c"]
+        _pipe(cmd, fin, fout)
+    elif cmp == "zlib" and igzip_threaded:
+        # ISA-L deflate, the header has no name and no timestamp
+        with igzip_threaded.open(
+            fout, "wb", compresslevel=ISAL_LEVEL, threads=threads
+        ) as gz:
+            shutil.copyfileobj(fin, gz, BUFFER_SIZE)
+    elif cmp == "zlib":
+        # No name and timestamp in the header, as with "gzip -n"
+        with gzip.GzipFile(
+            filename="", mode="wb", fileobj=fout, compresslevel=ZLIB_LEVEL, mtime=0
+        ) as gz:
+            shutil.copyfileobj(fin, gz, BUFFER_SIZE)
+    elif zstandard:
+        # threads=0 compresses in the calling thread
+        zstandard.ZstdCompressor(
+            level=3, threads=threads if threads > 1 else 0
+        ).copy_stream(fin, fout, read_size=BUFFER_SIZE, write_size=BUFFER_SIZE)
+    else:
+        _pipe(["zstd", "-z", f"-T{threads}", "-c"], fin, fout)
+
+
+def _aes_param(value, size, name):
+    # Like "openssl enc -K/-iv", short values are padded with zero bytes.
+    # Longer ones are rejected, openssl would silently drop the excess.
+    raw = bytes.fromhex(value)
+    if len(raw) > size:
+        raise ValueError(f"AES {name} is longer than {size} bytes")
+    if len(raw) < size:
+        logging.warning(
+            "AES %s is shorter than %d bytes, padding with zero bytes", name, size
+        )
+    return raw.ljust(size, b"\0")
+
+
+class _OutputStream:
+    """
+    Last stage when building an artifact: the data is encrypted
+    if requested, then hashed and written to the output file
+    """
+
+    def __init__(self, fout, encrypt=False, key=None, iv=None):
+        self.fout = fout
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.encryptor = None
+        if encrypt:
+            if not key or not iv:
+                raise ValueError("Encryption requested, but no key or IV given")
+            # Same output as "openssl enc -aes-256-cbc -K key -iv iv -nosalt",
+            # always AES-256 whatever the length of the key
+            self.encryptor = Cipher(
+                algorithms.AES(_aes_param(key, AES_KEY_SIZE, "key")),
+                modes.CBC(_aes_param(iv, AES_IV_SIZE, "IV")),
+            ).encryptor()
+            self.padder = PKCS7(algorithms.AES.block_size).padder()
+
+    def _output(self, data):
+        self.fout.write(data)
+        self.sha.update(data)
+        self.size += len(data)
+
+    def write(self, data):
+        if self.encryptor:
+            self._output(self.encryptor.update(self.padder.update(data)))
+        else:
+            self._output(data)
+        return len(data)
+
+    def flush(self):
+        self.fout.flush()
+
+    def finalize(self):
+        if self.encryptor:
+            self._output(
+                self.encryptor.update(self.padder.finalize())
+                + self.encryptor.finalize()
+            )
 
 
 class Artifact:
@@ -14,45 +218,43 @@ class Artifact:
         self._available = False
         self.sha256 = ""
         self.ivt = ""
+        self.compress = None
+        self.encrypted = False
         self.size = 0
 
     def exist(self):
         return os.path.exists(self.filename)
 
     def getsha256(self):
-        m = hashlib.sha256()
-        with open(os.path.join(self.fullfilename), "rb") as f:
-            while True:
-                data = f.read(1024)
-                if not data:
-                    break
-                m.update(data)
-            f.close()
-        self.sha256 = m.hexdigest()
+        path = os.path.realpath(self.fullfilename)
+        st = os.stat(path)
+        self.sha256 = _sha256_of(path, st.st_mtime_ns, st.st_size)
         return self.sha256
 
-    def findfile(self, artifactdirs):
-        for libdir in artifactdirs:
-            fname = os.path.join(libdir, self.filename)
-            if os.path.exists(fname):
-                self.fullfilename = fname
-                self.sha256 = self.getsha256()
-                self.size = os.path.getsize(fname)
-                return True
+    def findfile(self, artifactdirs, index=None):
+        fname = find_artifact(self.filename, artifactdirs, index)
+        if fname:
+            self.fullfilename = fname
+            self.size = os.path.getsize(fname)
+            return True
         return False
 
     def getsize(self):
         return self.size
 
+    def build(self, out, compress=None, encrypt=False, key=None, iv=None, threads=1):
+        # Source file -> compressor -> encryptor -> sha256 -> out, in a
+        # single pass. Returns sha256 and size of the generated file.
+        # threads is the number of threads the compressor may use.
+        with open(self.fullfilename, "rb") as fin, open(out, "wb") as fout:
+            stream = _OutputStream(fout, encrypt, key, iv)
+            if compress:
+                _compress(fin, stream, compress, threads)
+            else:
+                shutil.copyfileobj(fin, stream, BUFFER_SIZE)
+            stream.finalize()
+        return stream.sha.hexdigest(), stream.size
+
     def encrypt(self, out, key, iv):
-        enc_args = [
-            "openssl",
-            "enc",
-            "-aes-256-cbc",
-            "-in",
-            self.fullfilename,
-            "-out",
-            out,
-        ]
-        enc_args += ["-K", key, "-iv", iv, "-nosalt"]
-        subprocess.run(enc_args, check=True)
+        sha256, _ = self.build(out, encrypt=True, key=key, iv=iv)
+        return sha256
@@ -9,12 +9,57 @@ import shutil
 import secrets
 import subprocess
 import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
 from tempfile import TemporaryDirectory
 
 import libconf
 
 from swugenerator.swu_file import SWUFile
-from swugenerator.artifact import Artifact
+from swugenerator.artifact import (
+    COMPRESSION_ERRORS,
+    Artifact,
+    find_artifact,
+    index_artifacts,
+    log_hash_backend,
+)
+
+# @@VARIABLE@@ placeholders and $function(parms) calls in sw-description
+_VAR_RE = re.compile(r"@@(\w+)@@")
+_FUN_RE = re.compile(r"\$(\w+)\(([^)\n]+)\)")
+
+# Errors preparing an artifact that are reported instead of a traceback
+_BUILD_ERRORS = (
+    OSError,
+    ValueError,
+    subprocess.CalledProcessError,
+) + COMPRESSION_ERRORS
+
+
+def _prepare_artifact(artifact, workdir, aeskey, threads):
+    # Runs in a worker process: the artifact is a copy, so the resulting
+    # file and its sha256 are returned to the caller. threads is the
+    # share of the CPUs this worker's compressor may use.
+    if artifact.compress or artifact.encrypted:
+        new_path = os.path.join(workdir, artifact.newfilename)
+        try:
+            artifact.sha256, _ = artifact.build(
+                new_path,
+                compress=artifact.compress,
+                encrypt=artifact.encrypted,
+                key=aeskey,
+                iv=artifact.ivt,
+                threads=threads,
+            )
+        except _BUILD_ERRORS as e:
+            logging.critical("Cannot create %s: %s", artifact.newfilename, e)
+            sys.exit(1)
+        artifact.fullfilename = new_path
+    else:
+        artifact.getsha256()
+
+    return artifact.fullfilename, artifact.sha256
 
 
 class SWUGenerator:
@@ -34,11 +79,13 @@ class SWUGenerator:
     ):
         self.swdescription = template
         self.artifacts = []
+        self._artifact_by_name = {}
         self.out = open(out, "wb")
         self.artifactory = dirs
+        self._index = None
         self.cpiofile = SWUFile(self.out)
         self.vars = confvars
-        self.lines = []
+        self.text = ""
         self.conf = libconf.AttrDict()
         self.filelist = []
         self.temp = TemporaryDirectory()
@@ -55,27 +102,25 @@ class SWUGenerator:
         return secrets.token_hex(16)
 
     def _read_swdesc(self):
-        with codecs.open(self.swdescription, "r") as f:
-            self.lines = f.readlines()
-            f.close()
+        self.text = Path(self.swdescription).read_text(encoding="utf-8")
 
     def close(self):
         self.temp.cleanup()
         self.cpiofile.close()
         self.out.close()
 
+    def _add_artifact(self, artifact):
+        self.artifacts.append(artifact)
+        self._artifact_by_name[artifact.filename] = artifact
+
     def process_entry(self, entry):
         if "filename" not in entry:
-            return
-        new = None
-        for image in self.artifacts:
-            if image.filename == entry["filename"]:
-                new = image
-                break
+            return None
+        new = self._artifact_by_name.get(entry["filename"])
         if not new:
             logging.debug("New artifact  %s", entry["filename"])
             new = Artifact(entry["filename"])
-            if not new.findfile(self.artifactory):
+            if not new.findfile(self.artifactory, self._index):
                 logging.critical("Artifact %s not found", entry["filename"])
                 sys.exit(22)
 
@@ -83,47 +128,15 @@ class SWUGenerator:
 
             if "compressed" in entry and not self.nocompress:
                 cmp = entry["compressed"]
-                if cmp:
+                # "compressed = true" is the old syntax for zlib
+                if cmp is True:
                     cmp = "zlib"
                 if cmp not in ("zlib", "zstd"):
                     logging.critical("Wrong compression algorithm: %s", cmp)
                     sys.exit(1)
 
-                new_path = os.path.join(self.temp.name, new.newfilename) + "." + cmp
+                new.compress = cmp
                 new.newfilename = new.newfilename + "." + cmp
-                if cmp == "zlib":
-                    cmd = [
-                        "gzip",
-                        "-f",
-                        "-9",
-                        "-n",
-                        "-c",
-                        "--rsyncable",
-                        new.fullfilename,
-                        ">",
-                        new_path,
-                    ]
-                else:
-                    cmd = [
-                        "zstd",
-                        "-z",
-                        "-k",
-                        "-T0",
-                        "-c",
-                        new.fullfilename,
-                        ">",
-                        new_path,
-                    ]
-
-                try:
-                    subprocess.run(" ".join(cmd), shell=True, check=True, text=True)
-                except subprocess.CalledProcessError:
-                    logging.critical(
-                        "Cannot compress %s with %s", entry["filename"], cmd
-                    )
-                    sys.exit(1)
-
-                new.fullfilename = new_path
 
             # Encrypt if required
             if "encrypted" in entry and not self.noencrypt:
@@ -132,65 +145,103 @@ class SWUGenerator:
                         "%s must be encrypted, but no encryption key is given",
                         entry["filename"],
                     )
+                    sys.exit(1)
                 if self.noivt:
                     iv = self.aesiv
                 else:
                     iv = self.generate_iv()
 
+                new.encrypted = True
                 new.newfilename = new.newfilename + "." + "enc"
-                new_path = os.path.join(self.temp.name, new.newfilename)
-                new.encrypt(new_path, self.aeskey, iv)
-                new.fullfilename = new_path
-                # recompute sha256, now for the encrypted file
                 entry["ivt"] = iv
                 new.ivt = iv
 
-            self.artifacts.append(new)
+            self._add_artifact(new)
         else:
             logging.debug("Artifact  %s already stored", entry["filename"])
 
         entry["filename"] = new.newfilename
-        entry["sha256"] = new.getsha256()
         if "encrypted" in entry:
             entry["ivt"] = new.ivt
+        return new
+
+    def prepare_artifacts(self, artifacts):
+        # Artifacts are independent from each other, so compress,
+        # encrypt and hash them in parallel. While a worker waits for
+        # pigz or zstd, the other workers go on with their artifacts.
+        ncpu = os.cpu_count() or 1
+        if len(artifacts) < 2:
+            # Starting worker processes is not worth it
+            for artifact in artifacts:
+                artifact.fullfilename, artifact.sha256 = _prepare_artifact(
+                    artifact, self.temp.name, self.aeskey, ncpu
+                )
+            return
+        workers = min(len(artifacts), ncpu)
+        # Multithreaded compressors share the CPUs with the other workers
+        threads = max(1, ncpu // workers)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            jobs = [
+                (
+                    a,
+                    pool.submit(
+                        _prepare_artifact, a, self.temp.name, self.aeskey, threads
+                    ),
+                )
+                for a in artifacts
+            ]
+            for artifact, job in jobs:
+                artifact.fullfilename, artifact.sha256 = job.result()
 
     def find_files_in_swdesc(self, first):
-        for n, val in first.items():
-            if isinstance(val, libconf.AttrDict):
-                self.find_files_in_swdesc(val)
-            elif isinstance(val, tuple):
-                for t in val:
-                    self.find_files_in_swdesc(t)
-            else:
-                logging.debug("%s = %s", n, val)
-                if n == "filename":
-                    self.filelist.append(first)
+        stack = deque([first])
+        while stack:
+            node = stack.pop()
+            children = []
+            for n, val in node.items():
+                if isinstance(val, libconf.AttrDict):
+                    children.append(val)
+                elif isinstance(val, tuple):
+                    children.extend(val)
+                else:
+                    logging.debug("%s = %s", n, val)
+                    if n == "filename":
+                        self.filelist.append(node)
+            # Visit children in document order
+            stack.extend(reversed(children))
 
     def save_swdescription(self, filename, contents):
         with codecs.open(filename, "w", "utf-8") as swd:
             swd.write(contents)
 
     def process(self):
+        log_hash_backend()
+        self._index = index_artifacts(self.artifactory)
         self._read_swdesc()
         self._expand_variables()
         self._exec_functions()
 
-        swdesc = ""
-        for line in self.lines:
-            swdesc = swdesc + line
-        self.conf = libconf.loads(swdesc)
+        self.conf = libconf.loads(self.text)
         self.find_files_in_swdesc(self.conf.software)
 
         sw = Artifact("sw-description")
         sw.fullfilename = os.path.join(self.temp.name, sw.filename)
-        self.artifacts.append(sw)
+        self._add_artifact(sw)
         if self.signtool:
             sig = Artifact("sw-description.sig")
             sig.fullfilename = os.path.join(self.temp.name, "sw-description.sig")
-            self.artifacts.append(sig)
+            self._add_artifact(sig)
 
+        entries = []
         for entry in self.filelist:
-            self.process_entry(entry)
+            artifact = self.process_entry(entry)
+            if artifact:
+                entries.append((entry, artifact))
+
+        # the same artifact can be referenced by more entries
+        self.prepare_artifacts(list(dict.fromkeys(a for _, a in entries)))
+        for entry, artifact in entries:
+            entry["sha256"] = artifact.sha256
 
         swdesc = libconf.dumps(self.conf)
 
@@ -216,6 +267,7 @@ class SWUGenerator:
                 logging.critical(
                     "sw-description must be encrypted, but no encryption key is given"
                 )
+                sys.exit(1)
 
             iv = self.aesiv
             sw.fullfilename = swdesc_filename
@@ -227,44 +279,17 @@ class SWUGenerator:
             self.cpiofile.addartifacttoswu(artifact.fullfilename)
 
     def _expand_variables(self):
-        write_lines = []
-        for line in self.lines:
-            while True:
-                m = re.match(
-                    r"^(?P<before_placeholder>.+)@@(?P<variable_name>\w+)@@(?P<after_placeholder>.+)$",
-                    line,
-                )
-                if m:
-                    variable_value = self.vars[m.group("variable_name")]
-                    line = (
-                        m.group("before_placeholder")
-                        + variable_value
-                        + m.group("after_placeholder")
-                    )
-                    continue
-                else:
-                    break
-            write_lines.append(line)
-        self.lines = write_lines
+        self.text = _VAR_RE.sub(lambda m: self.vars[m.group(1)], self.text)
 
     def _exec_functions(self):
-        for index, line in enumerate(self.lines):
-            m = re.match(
-                r"^(?P<before_placeholder>.+)\$(?P<function_name>\w+)\((?P<parms>.+)\)(?P<after_placeholder>.+)$",
-                line,
-            )
-            if m:
-                fun = (
-                    "self." + m.group("function_name") + '("' + m.group("parms") + '")'
-                )
-                ret = eval(fun)
-                line = (
-                    m.group("before_placeholder")
-                    + ret
-                    + m.group("after_placeholder")
-                    + "\n"
-                )
-                self.lines[index] = line
+        def call(m):
+            fun = self._TEMPLATE_FUNCS.get(m.group(1))
+            if not fun:
+                logging.debug("%s is not a template function", m.group(1))
+                return m.group(0)
+            return fun(self, m.group(2).strip('"'))
+
+        self.text = _FUN_RE.sub(call, self.text)
 
     def setenckey(self, k, iv):
         self.aeskey = k
@@ -272,10 +297,17 @@ class SWUGenerator:
 
     def swupdate_get_sha256(self, filename):
         a = Artifact(filename)
+        a.findfile(self.artifactory, self._index)
         return a.getsha256()
 
     def swupdate_get_size(self, filename):
-        a = Artifact(filename)
-        if a.findfile(self.artifactory):
-            return str(a.getsize())
+        path = find_artifact(filename, self.artifactory, self._index)
+        if path:
+            return str(os.stat(path).st_size)
         return "0"
+
+    # Functions that can be called from sw-description as $name(parms)
+    _TEMPLATE_FUNCS = {
+        "swupdate_get_sha256": swupdate_get_sha256,
+        "swupdate_get_size": swupdate_get_size,
+    }
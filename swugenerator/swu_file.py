@@ -7,6 +7,9 @@
 import os
 import stat
 
+# Chunk size when sendfile() is not available
+COPY_BUFFER_SIZE = 1024 * 1024
+
 
 class CPIOException(Exception):
     pass
@@ -44,6 +47,32 @@ class SWUFile:
         crc = crc & 0xFFFFFFFF
         return crc
 
+    def _sendfile(self, infile, size):
+        """
+        Copy up to size bytes from infile to the archive in the kernel.
+        Returns the bytes copied, 0 if sendfile() cannot be used
+
+        :type infile: FileIO of bytes
+        """
+        if not hasattr(os, "sendfile"):
+            return 0
+        copied = 0
+        try:
+            self.outfile.flush()
+            outfd = self.outfile.fileno()
+            while copied < size:
+                sent = os.sendfile(outfd, infile.fileno(), copied, size - copied)
+                if not sent:
+                    break
+                copied += sent
+        except OSError:
+            # not supported for these files, let the caller copy them
+            if copied:
+                raise
+        infile.seek(copied)
+        self.position += copied
+        return copied
+
     def addartifacttoswu(self, cpio_filename):
         """
         :type cpio_filename: string
@@ -68,8 +97,9 @@ class SWUFile:
 
         self._align()
         with open(cpio_filename, "rb") as xxx:
+            size -= self._sendfile(xxx, size)
             while size:
-                chunk = xxx.read(65536)
+                chunk = xxx.read(COPY_BUFFER_SIZE)
                 if not chunk:
                     break
                 self._rawwrite(chunk)